@@ -13,13 +13,13 @@ Examples:
 
 from __future__ import annotations
 
-import json
 import os
 import sys
 import urllib.error
 import urllib.request
 from typing import Any
 
+import orjson
 import typer
 
 app = typer.Typer(add_completion=False)
@@ -28,7 +28,7 @@ DEFAULT_OLLAMA_BASE = "http://localhost:11434"
 
 
 def post_json(url: str, payload: dict[str, Any], timeout_s: float) -> dict[str, Any]:
-    data = json.dumps(payload).encode("utf-8")
+    data = orjson.dumps(payload)
     req = urllib.request.Request(
         url,
         data=data,
@@ -38,8 +38,7 @@ def post_json(url: str, payload: dict[str, Any], timeout_s: float) -> dict[str,
 
     try:
         with urllib.request.urlopen(req, timeout=timeout_s) as resp:
-            body = resp.read().decode("utf-8", errors="replace")
-            return json.loads(body)
+            return orjson.loads(resp.read())
     except urllib.error.HTTPError as e:
         err_body = (
             e.read().decode("utf-8", errors="replace") if hasattr(e, "read") else ""
@@ -47,7 +46,7 @@ def post_json(url: str, payload: dict[str, Any], timeout_s: float) -> dict[str,
         raise RuntimeError(f"HTTP {e.code} calling {url}: {err_body}") from e
     except urllib.error.URLError as e:
         raise RuntimeError(f"Connection error calling {url}: {e}") from e
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         raise RuntimeError(f"Invalid JSON from {url}: {e}") from e
 
 
@@ -91,7 +90,7 @@ def generate(
         raise typer.Exit(code=1)
 
     if json_out:
-        typer.echo(json.dumps(resp, indent=2, ensure_ascii=False))
+        typer.echo(orjson.dumps(resp, option=orjson.OPT_INDENT_2).decode())
         raise typer.Exit()
 
     text = resp.get("response", "")